@@ -10,10 +10,45 @@ import dendropy
 import os
 import json
 import argparse
-import random
 import re
 import sys
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+TS_NODE_LABEL_RE = re.compile(r'\)(TS_NODE_\d+)')
+
+def load_json(path):
+    """
+    Loads a JSON file, using orjson when it is installed. orjson rejects
+    NaN/Infinity, which Python-written summaries may contain, so files it
+    cannot decode are re-read with the stdlib json module.
+    """
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            return json.loads(raw)
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def dump_json(obj, path):
+    """
+    Writes obj as 2-space indented JSON, using orjson when it is installed.
+    With orjson, non-ASCII text is written as raw UTF-8 rather than \\u
+    escapes and NaN/Infinity are written as null.
+    """
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+        return
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=2)
+
 def normalize_taxon_label(label):
     """
     Normalizes taxon labels to consistent 'strain|date' format.
@@ -40,6 +75,36 @@ def normalize_tree_taxa(tree):
         if leaf.taxon and leaf.taxon.label:
             leaf.taxon.label = normalize_taxon_label(leaf.taxon.label)
 
+def annotate_leafsets(tree):
+    """
+    Caches each node's descendant leaf labels on node._leaves in a single
+    postorder pass, unioning the children's cached sets.
+    """
+    for node in tree.postorder_node_iter():
+        children = node.child_nodes()
+        if not children:
+            taxon = node.taxon
+            if taxon and taxon.label:
+                node._leaves = frozenset((taxon.label,))
+            else:
+                node._leaves = frozenset()
+        else:
+            node._leaves = frozenset().union(*(child._leaves for child in children))
+
+def build_paren_match_table(tree_string):
+    """
+    Maps the position of each closing parenthesis to the position of its
+    matching opening parenthesis (-1 if unmatched) in one forward pass.
+    """
+    match_of = [-1] * len(tree_string)
+    stack = []
+    for i, char in enumerate(tree_string):
+        if char == '(':
+            stack.append(i)
+        elif char == ')' and stack:
+            match_of[i] = stack.pop()
+    return match_of
+
 def build_source_leaf_map_from_tree_string(tree_path):
     """
     Builds a comprehensive map of {node_label: leaf_set} from source tree,
@@ -56,8 +121,10 @@ def build_source_leaf_map_from_tree_string(tree_path):
     try:
         tree = dendropy.Tree.get(data=tree_string, schema="newick", 
                                 suppress_internal_node_taxa=True, 
-                                suppress_leaf_node_taxa=False)
+                                suppress_leaf_node_taxa=False,
+                                preserve_underscores=True)
         normalize_tree_taxa(tree)
+        annotate_leafsets(tree)
         
         # Build leaf map for all nodes
         for node in tree.preorder_node_iter():
@@ -68,48 +135,38 @@ def build_source_leaf_map_from_tree_string(tree_path):
                 node_label = normalize_taxon_label(node.taxon.label)
             
             if node_label:
-                leaf_set = frozenset(normalize_taxon_label(leaf.taxon.label) 
-                                   for leaf in node.leaf_nodes() 
-                                   if leaf.taxon and leaf.taxon.label)
-                source_leaf_map[node_label] = leaf_set
+                source_leaf_map[node_label] = node._leaves
                 
     except Exception as e:
         print(f"Warning: Could not parse full tree: {e}")
     
-    # Extract internal nodes using regex approach as backup
-    label_matches = list(re.finditer(r'\)(TS_NODE_\d+)', tree_string))
-    
-    for match in label_matches:
-        node_label = match.group(1)
-        if node_label in source_leaf_map:
-            continue  # Already processed
-            
-        # Find the clade boundaries
-        clade_end_pos = match.start()
-        paren_balance = 1
-        clade_start_pos = -1
+    # Extract internal nodes using regex approach as backup; only needed
+    # when the primary parse did not recover any TS_NODE labels
+    if not any(label.startswith('TS_NODE_') for label in source_leaf_map):
+        label_matches = list(TS_NODE_LABEL_RE.finditer(tree_string))
+        match_of = build_paren_match_table(tree_string)
         
-        for i in range(clade_end_pos - 1, -1, -1):
-            char = tree_string[i]
-            if char == ')': 
-                paren_balance += 1
-            elif char == '(': 
-                paren_balance -= 1
-            if paren_balance == 0:
-                clade_start_pos = i
-                break
+        for match in label_matches:
+            node_label = match.group(1)
+            if node_label in source_leaf_map:
+                continue  # Already processed
+            
+            # Find the clade boundaries
+            clade_end_pos = match.start()
+            clade_start_pos = match_of[clade_end_pos]
         
-        if clade_start_pos != -1:
-            clade_str = tree_string[clade_start_pos : clade_end_pos + 1]
-            try:
-                temp_tree = dendropy.Tree.get(data=f"{clade_str};", schema="newick")
-                normalize_tree_taxa(temp_tree)
-                leaf_set = frozenset(normalize_taxon_label(l.taxon.label) 
-                                   for l in temp_tree.leaf_nodes() 
-                                   if l.taxon and l.taxon.label)
-                source_leaf_map[node_label] = leaf_set
-            except:
-                continue
+            if clade_start_pos != -1:
+                clade_str = tree_string[clade_start_pos : clade_end_pos + 1]
+                try:
+                    temp_tree = dendropy.Tree.get(data=f"{clade_str};", schema="newick",
+                                                  preserve_underscores=True)
+                    normalize_tree_taxa(temp_tree)
+                    leaf_set = frozenset(normalize_taxon_label(l.taxon.label) 
+                                       for l in temp_tree.leaf_nodes() 
+                                       if l.taxon and l.taxon.label)
+                    source_leaf_map[node_label] = leaf_set
+                except:
+                    continue
     
     print(f"Successfully parsed {len(source_leaf_map)} nodes from source tree.")
     return source_leaf_map
@@ -131,22 +188,27 @@ def get_labeled_canonical_tree(newick_path):
 
 def build_target_leaf_map(target_tree):
     """
-    Builds efficient leaf mapping for target tree with both forward and inverse maps.
+    Builds the inverse leaf mapping {leaf_set: node_label} for the target tree.
+    Where several nodes share a leaf set (unary chains), the deepest one wins.
     """
-    target_leaf_map = {}
     target_leaf_map_inv = {}
+    annotate_leafsets(target_tree)
     
-    for node in target_tree.preorder_node_iter():
+    for node in target_tree.postorder_node_iter():
         node_label = node.label or (node.taxon and node.taxon.label)
         if node_label:
-            leaf_set = frozenset(leaf.taxon.label for leaf in node.leaf_nodes() 
-                               if leaf.taxon and leaf.taxon.label)
-            target_leaf_map[node_label] = leaf_set
-            target_leaf_map_inv[leaf_set] = node_label
+            target_leaf_map_inv.setdefault(node._leaves, node_label)
     
-    return target_leaf_map, target_leaf_map_inv
+    return target_leaf_map_inv
+
+def build_target_leaf_index(target_tree):
+    """
+    Indexes target tree leaf nodes by taxon label for O(1) lookup.
+    """
+    return {leaf.taxon.label: leaf for leaf in target_tree.leaf_node_iter()
+            if leaf.taxon and leaf.taxon.label}
 
-def map_node_with_ancestral_walk(source_leaf_set, target_tree, target_leaf_map_inv, debug=False, node_label=""):
+def map_node_with_ancestral_walk(source_leaf_set, target_leaf_index, target_leaf_map_inv, debug=False, node_label=""):
     """
     Efficient O(H) ancestral walk algorithm to find the corresponding node in target tree.
     """
@@ -162,25 +224,26 @@ def map_node_with_ancestral_walk(source_leaf_set, target_tree, target_leaf_map_i
         return None
     
     # Ancestral walk approach
-    random_leaf_label = random.choice(list(source_leaf_set))
+    start_leaf_label = next(iter(source_leaf_set))
     if debug: 
-        print(f"  → Starting ancestral walk from '{random_leaf_label}' for {node_label}")
+        print(f"  → Starting ancestral walk from '{start_leaf_label}' for {node_label}")
     
     # Find the leaf node in target tree
-    leaf_node = target_tree.find_node_with_taxon_label(random_leaf_label)
+    leaf_node = target_leaf_index.get(start_leaf_label)
     if not leaf_node:
         if debug: 
-            print(f"  ✗ Could not find leaf '{random_leaf_label}' in target tree")
+            print(f"  ✗ Could not find leaf '{start_leaf_label}' in target tree")
         return None
     
-    # Walk up the ancestry
+    # Walk up the ancestry; clades only grow towards the root, so ancestors
+    # smaller than the source clade are skipped without a subset check
+    source_size = len(source_leaf_set)
+    is_contained_in = source_leaf_set.issubset
     current_node = leaf_node.parent_node
     while current_node:
-        current_label = current_node.label or (current_node.taxon and current_node.taxon.label)
-        current_leaves = frozenset(leaf.taxon.label for leaf in current_node.leaf_nodes() 
-                                 if leaf.taxon and leaf.taxon.label)
-        
-        if source_leaf_set.issubset(current_leaves):
+        current_leaves = current_node._leaves
+        if len(current_leaves) >= source_size and is_contained_in(current_leaves):
+            current_label = current_node.label or (current_node.taxon and current_node.taxon.label)
             if debug: 
                 print(f"  ✓ Found containing clade at '{current_label}' for {node_label}")
             return current_label
@@ -231,8 +294,7 @@ def main(args):
     
     # Load summary data
     print("--- Loading summary data ---")
-    with open(args.summary_json, 'r') as f:
-        summary_data = json.load(f)
+    summary_data = load_json(args.summary_json)
     
     # Parse target tree and add labels
     print("--- Loading and labeling target tree ---")  
@@ -243,12 +305,16 @@ def main(args):
     
     # Build target leaf maps
     print("--- Building target tree leaf maps ---")
-    target_leaf_map, target_leaf_map_inv = build_target_leaf_map(target_tree)
+    target_leaf_map_inv = build_target_leaf_map(target_tree)
+    target_leaf_index = build_target_leaf_index(target_tree)
     
     # Validate leaf set consistency
-    source_leaves = {leaf for leaf_set in source_leaf_map.values() for leaf in leaf_set}
-    target_leaves = {leaf for leaf in target_leaf_map_inv if len(leaf) == 1}
-    target_leaves = {list(leaf_set)[0] for leaf_set in target_leaves}
+    # Leaf entries map a label to a leaf set containing only that label
+    source_leaves = {label for label, leaf_set in source_leaf_map.items() if label in leaf_set}
+    if not source_leaves:
+        # Only regex-recovered clades available; fall back to their union
+        source_leaves = set().union(*source_leaf_map.values())
+    target_leaves = set(target_leaf_index)
     
     print(f"Source tree leaves: {len(source_leaves)}")
     print(f"Target tree leaves: {len(target_leaves)}")
@@ -269,34 +335,46 @@ def main(args):
     # Process summary data and map to target tree
     print("--- Mapping summary annotations to target tree ---")
     mapped_summary_data = {}
-    high_confidence_count = 0
     mapped_count = 0
     
+    # Keep only high-confidence reassortment events before mapping
+    events = []
     for source_node_label, data in summary_data.items():
-        is_reassorted = data.get("reassorted") == "True"
-        confidence = data.get("reassorted confidence", {}).get("True", 0)
-        
+        if data.get("reassorted") == "True":
+            confidence = data.get("reassorted confidence", {}).get("True", 0)
+            if confidence >= CONFIDENCE_THRESHOLD:
+                events.append((source_node_label, data, confidence))
+                continue
+        if args.debug and source_node_label.startswith("TS_NODE"):
+            confidence = data.get("reassorted confidence", {}).get("True", 0)
+            print(f"\n--- Skipping {source_node_label} (reassorted: {data.get('reassorted')}, "
+                  f"confidence: {confidence:.3f}) ---")
+    high_confidence_count = len(events)
+    
+    if args.debug:
+        print(f"\nSkipped {len(summary_data) - high_confidence_count} of "
+              f"{len(summary_data)} summary entries below threshold or not reassorted")
+    
+    for source_node_label, data, confidence in events:
         if args.debug and source_node_label.startswith("TS_NODE"):
             print(f"\n--- Processing {source_node_label} (confidence: {confidence:.3f}) ---")
         
-        if is_reassorted and confidence >= CONFIDENCE_THRESHOLD:
-            high_confidence_count += 1
-            
-            if source_node_label in source_leaf_map:
-                source_leaf_set = source_leaf_map[source_node_label]
-                target_node_label = map_node_with_ancestral_walk(
-                    source_leaf_set, target_tree, target_leaf_map_inv, 
-                    args.debug, source_node_label
-                )
-                
-                if target_node_label:
-                    mapped_summary_data[target_node_label] = data
-                    mapped_count += 1
-                elif args.debug:
-                    print(f"  ✗ Failed to map {source_node_label}")
-            else:
-                if args.debug:
-                    print(f"  ✗ {source_node_label} not found in source leaf map")
+        source_leaf_set = source_leaf_map.get(source_node_label)
+        if source_leaf_set is None:
+            if args.debug:
+                print(f"  ✗ {source_node_label} not found in source leaf map")
+            continue
+        
+        target_node_label = map_node_with_ancestral_walk(
+            source_leaf_set, target_leaf_index, target_leaf_map_inv, 
+            args.debug, source_node_label
+        )
+        
+        if target_node_label:
+            mapped_summary_data[target_node_label] = data
+            mapped_count += 1
+        elif args.debug:
+            print(f"  ✗ Failed to map {source_node_label}")
     
     print(f"\nSUMMARY:")
     print(f"  High confidence events in summary: {high_confidence_count}")
@@ -312,8 +390,7 @@ def main(args):
     
     # Write augur node data
     augur_node_data = create_augur_node_data(mapped_summary_data)
-    with open(args.output_node_data, 'w') as f:
-        json.dump(augur_node_data, f, indent=2)
+    dump_json(augur_node_data, args.output_node_data)
     print(f"✓ Augur node data: {args.output_node_data}")
     
     print("=== Mapping completed successfully ===")